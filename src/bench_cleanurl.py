@@ -0,0 +1,529 @@
+"""Micro benchmarks for cleanurl.
+
+Run all of them with `python bench_cleanurl.py` or only some with
+`python bench_cleanurl.py str many`.
+"""
+
+import cleanurl
+import random
+import sys
+import time
+
+URLS = [
+    "https://www.xojoc.pw/blog/focus.html?utm_content=buffercf3b2&utm_medium=social&utm_source=snapchat.com&utm_campaign=buffe",
+    "https://github.com/xojoc/discussions/tree/master",
+    "https://www.youtube.com/watch?v=71SsVUmT1ys&ignore=query",
+    "https://youtu.be/71SsVUmT1ys",
+    "https://twitter.com/RustDiscussions/status/1448994137504686086?s=19",
+    "https://threadreaderapp.com/thread/1453753924960219145",
+    "https://en.m.wikipedia.org/wiki/Daphne_Caruana_Galizia",
+    "https://old.reddit.com/r/wallstreetbets/comments/sv6clr/there_wont_be_a_war_in_ukraine_because_russia/",
+    "https://stackoverflow.com/questions/69503317/bubble-sort-slower-with-o3-than-o2-with-gcc",
+    "https://www.nytimes.com/2006/10/11/technology/11yahoo.html?ex=1318219200&en=538f73d9faa9d263&ei=5090&partner=rssuserland&emc=rss",
+    "https://edition.cnn.com/2021/09/29/business/supply-chain-workers/index.html",
+    "https://www.google.com/amp/s/www.cnbc.com/amp/2021/04/27/archegos-hit-to-ubs-stuns-investors-as-shares-slide.html",
+    "https://web.archive.org/web/20200103092739/https://www.xojoc.pw/blog/focus.html",
+    "https://www.amazon.it/Free-Freedom-Paperback-Stallmans-Software-ebook/dp/B006GCNP5S/ref=sr_1_2?keywords=richard+stallman&qid=1645805689",
+    "https://dl.acm.org/doi/pdf/10.1145/3371071",
+    "https://example.com/a/b/c?x=1&y=2#fragment",
+]
+
+
+def corpus(n, seed=0):
+    """n urls made from URLS with a varying last path segment."""
+    rnd = random.Random(seed)
+    urls = []
+    for i in range(n):
+        head, sep, tail = rnd.choice(URLS).partition("?")
+        urls.append(f"{head}/{i}{sep}{tail}")
+    return urls
+
+
+def timed(f, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, seconds, n, unit="urls"):
+    print(
+        f"{name:48} {n / seconds:10,.0f} {unit}/s {seconds / n * 1e6:6.2f} us"
+    )
+
+
+def allocated_per_call(f, urls):
+    """Average bytes allocated at the peak of a call to f(url), and kept.
+
+    Each url is cleaned once before, so the lru caches of cleanurl are
+    warm and their growth isn't counted.
+    """
+    import tracemalloc
+
+    for u in urls:
+        f(u)
+    peak = kept = 0
+    tracemalloc.start()
+    for u in urls:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = f(u)
+        current, top = tracemalloc.get_traced_memory()
+        del result
+        peak += top - before
+        kept += current - before
+    tracemalloc.stop()
+    return peak / len(urls), kept / len(urls)
+
+
+def retained_blocks_per_url(f, urls):
+    before = sys.getallocatedblocks()
+    results = f(urls)
+    after = sys.getallocatedblocks()
+    del results
+    return (after - before) / len(urls)
+
+
+def bench_str():
+    urls = corpus(20_000)
+    report(
+        "cleanurl(u).url",
+        timed(lambda: [cleanurl.cleanurl(u).url for u in urls]),
+        len(urls),
+    )
+    report(
+        "cleanurl_str(u)",
+        timed(lambda: [cleanurl.cleanurl_str(u) for u in urls]),
+        len(urls),
+    )
+
+
+def bench_many():
+    urls = corpus(5_000)
+    for name, f in (
+        ("cleanurl(u)", cleanurl.cleanurl),
+        ("cleanurl(u).url", lambda u: cleanurl.cleanurl(u).url),
+        ("cleanurl_str(u)", cleanurl.cleanurl_str),
+    ):
+        peak, kept = allocated_per_call(f, urls)
+        print(f"{name:48} {peak:8.0f} bytes peak/call {kept:6.0f} kept")
+
+    # Size of the results held by the caller, not what a call allocates.
+    urls = corpus(50_000)
+    print(
+        "retained blocks/url [cleanurl_str]",
+        retained_blocks_per_url(
+            lambda us: [cleanurl.cleanurl_str(u) for u in us], urls
+        ),
+    )
+    print(
+        "retained blocks/url cleanurl_many",
+        retained_blocks_per_url(cleanurl.cleanurl_many, urls),
+    )
+    print(
+        "retained blocks/url cleanurl_many(intern=True)",
+        retained_blocks_per_url(
+            lambda us: cleanurl.cleanurl_many(us, intern=True), urls
+        ),
+    )
+
+
+def bench_tracking_params():
+    keys = [f"k{i}" for i in range(100)] + ["utm_source", "id", "v", "page"]
+    names = frozenset(["gclid", "fbclid", "utm_source", "utm_medium"])
+    many = cleanurl.TrackingParams(
+        [f"param{i}" for i in range(300)]
+        + [f"prefix{i}_*" for i in range(100)]
+        + ["utm_*", "vero_*"]
+    )
+    n = 20
+    report(
+        "frozenset lookup",
+        timed(lambda: [k in names for _ in range(n) for k in keys]),
+        n * len(keys),
+        "keys",
+    )
+    report(
+        "TRACKING_PARAMS.matches",
+        timed(
+            lambda: [
+                cleanurl.TRACKING_PARAMS.matches(k)
+                for _ in range(n)
+                for k in keys
+            ]
+        ),
+        n * len(keys),
+        "keys",
+    )
+    report(
+        "402 patterns .matches",
+        timed(lambda: [many.matches(k) for _ in range(n) for k in keys]),
+        n * len(keys),
+        "keys",
+    )
+
+
+def bench_host():
+    paths = corpus(20_000)
+    for hosts in (10, 1_000, 20_000):
+        urls = [
+            u.replace("://", f"://bücher{i % hosts}.", 1)
+            for i, u in enumerate(paths)
+        ]
+        cleanurl.cleanurl_str(urls[0])
+        report(
+            f"cleanurl_str, {hosts} distinct idna hosts",
+            timed(lambda: [cleanurl.cleanurl_str(u) for u in urls]),
+            len(urls),
+        )
+
+    canonical_host = vars(cleanurl)["__canonical_host"]
+    netlocs = [f"www.bücher{i % 100}.de:443" for i in range(20_000)]
+    report(
+        "host normalization, uncached",
+        timed(
+            lambda: [
+                canonical_host.__wrapped__(h, "https", False) for h in netlocs
+            ]
+        ),
+        len(netlocs),
+        "hosts",
+    )
+    report(
+        "host normalization, cached",
+        timed(lambda: [canonical_host(h, "https", False) for h in netlocs]),
+        len(netlocs),
+        "hosts",
+    )
+
+
+def bench_trace():
+    urls = corpus(20_000)
+    report(
+        "cleanurl(u)",
+        timed(lambda: [cleanurl.cleanurl(u) for u in urls]),
+        len(urls),
+    )
+    report(
+        "cleanurl(u, trace=True)",
+        timed(lambda: [cleanurl.cleanurl(u, trace=True) for u in urls]),
+        len(urls),
+    )
+
+
+def bench_percent():
+    import re
+    import string
+
+    unreserved = set(string.ascii_letters + string.digits + "-._~")
+
+    def with_re_sub(s):
+        def sub(m):
+            c = chr(int(m.group(1), 16))
+            return c if c in unreserved else m.group().upper()
+
+        return re.sub("%([0-9A-Fa-f]{2})", sub, s)
+
+    percent = vars(cleanurl)["__canonical_percent_encoding"]
+    paths = [
+        "/blog/focus",
+        "/%7Euser/caf%c3%a9/a%2fb/%41%42%43",
+        "/wiki/Caf%C3%A9_%28disambiguation%29",
+    ] * 10_000
+    report(
+        "re.sub with a callback",
+        timed(lambda: [with_re_sub(p) for p in paths]),
+        len(paths),
+        "paths",
+    )
+    report(
+        "table driven",
+        timed(lambda: [percent(p) for p in paths]),
+        len(paths),
+        "paths",
+    )
+
+
+def bench_public_suffix():
+    import tracemalloc
+
+    cleanurl._public_suffix_trie.cache_clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    cleanurl._public_suffix_trie()
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"load and compile: {seconds * 1000:.1f} ms, {size / 2**20:.2f} MiB")
+
+    for host in (
+        "amazon.com",
+        "www.amazon.co.uk",
+        "a.b.c.d.example.github.io",
+        "a.b.c.d.e.f.g.h.example.com",
+    ):
+        hosts = [host] * 50_000
+        report(
+            host,
+            timed(lambda: [cleanurl.registrable_domain(h) for h in hosts]),
+            len(hosts),
+            "hosts",
+        )
+
+
+def bench_serve(clients=4):
+    """Load test `cleanurl serve` running in its own process."""
+    import http.client
+    import subprocess
+    import threading
+
+    for workers in (0, 4):
+        server = subprocess.Popen(
+            [sys.executable, cleanurl.__file__, "serve", "--port", "0"]
+            + ["--workers", str(workers), "--max-body", str(2**30)],
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        address = server.stderr.readline().split("//")[1].strip()
+        try:
+            for size, requests in ((1, 2000), (100, 400), (10_000, 8)):
+                body = "\n".join(corpus(size)).encode()
+                latencies = []
+
+                def client():
+                    conn = http.client.HTTPConnection(address)
+                    for _ in range(requests // clients):
+                        start = time.perf_counter()
+                        conn.request(
+                            "POST",
+                            "/clean",
+                            body,
+                            {"Content-Type": "text/plain"},
+                        )
+                        conn.getresponse().read()
+                        latencies.append(time.perf_counter() - start)
+                    conn.close()
+
+                threads = [
+                    threading.Thread(target=client) for _ in range(clients)
+                ]
+                start = time.perf_counter()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                seconds = time.perf_counter() - start
+                latencies.sort()
+                p99 = latencies[int(len(latencies) * 0.99) - 1]
+                print(
+                    f"workers {workers}, batch {size:6}:"
+                    f" {len(latencies) / seconds:8,.0f} req/s"
+                    f" {len(latencies) * size / seconds:10,.0f} urls/s"
+                    f" p99 {p99 * 1000:8.2f} ms"
+                )
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_adversarial():
+    """Worst case inputs of growing size, cleaned with limits high enough
+    not to get in the way (the time per char should stay about flat) and
+    with the default ones."""
+    cases = {
+        "query pairs": lambda n: "https://example.com/?"
+        + "&".join(f"a{i}=1" for i in range(n)),
+        "dot segments": lambda n: "https://example.com" + "/a/.." * n,
+        "suffixes": lambda n: "https://example.com/a" + "/index" * n,
+        "amp segments": lambda n: "https://www.google.com/amp/"
+        + "a/" * n
+        + "example.com/",
+        "web.archive.org nesting": lambda n: "https://web.archive.org/web/1/"
+        * (n // 100)
+        + "https://example.com/",
+    }
+    unlimited = cleanurl.Limits(
+        max_length=10**9,
+        max_query_pairs=10**9,
+        max_path_segments=10**9,
+        max_depth=10**9,
+    )
+    for name, make in cases.items():
+        for n in (1_000, 10_000, 100_000):
+            url = make(n)
+            for limits in (unlimited, cleanurl.LIMITS):
+                seconds = timed(
+                    lambda: cleanurl.cleanurl_str(url, limits=limits),
+                    repeat=1,
+                )
+                print(
+                    f"{name:24} {len(url):9,} chars"
+                    f" {'default' if limits is cleanurl.LIMITS else 'no':7}"
+                    f" limits {seconds * 1000:10.2f} ms"
+                    f" {seconds / len(url) * 1e9:8.0f} ns/char"
+                )
+
+
+def bench_canonical_host():
+    ordinary = [
+        f"https://www.site{i % 1000}.com/news/2021/{i}/a.html?utm_source=x&id={i}"
+        for i in range(20_000)
+    ]
+    for name, urls in (
+        ("URLS corpus", corpus(20_000)),
+        ("ordinary", ordinary),
+    ):
+        report(
+            f"cleanurl(u).netloc, {name}",
+            timed(lambda: [cleanurl.cleanurl(u).netloc for u in urls]),
+            len(urls),
+        )
+        report(
+            f"canonical_host(u), {name}",
+            timed(lambda: [cleanurl.canonical_host(u) for u in urls]),
+            len(urls),
+        )
+        report(
+            f"partition(u, 64), {name}",
+            timed(lambda: [cleanurl.partition(u, 64) for u in urls]),
+            len(urls),
+        )
+
+
+def bench_extract_links():
+    import html.parser
+    from urllib import parse as urlparse
+
+    class Hrefs(html.parser.HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.hrefs = []
+
+        def handle_starttag(self, tag, attrs):
+            self.hrefs.extend(v for k, v in attrs if k == "href" and v)
+
+    def naive(page, url):
+        parser = Hrefs()
+        parser.feed(page)
+        return [
+            (h, cleanurl.cleanurl(urlparse.urljoin(url, h)))
+            for h in parser.hrefs
+        ]
+
+    url = "https://www.xojoc.pw/blog/index.html"
+    rnd = random.Random(0)
+    hrefs = [u.partition("://")[2].partition("/")[2] for u in corpus(200)]
+    hrefs += corpus(100)
+    for n in (1_000, 5_000):
+        page = "".join(
+            f'<li><a href="{rnd.choice(hrefs)}">link</a></li>\n'
+            for _ in range(n)
+        )
+        report(
+            f"naive extract then clean, {n} links",
+            timed(lambda: naive(page, url)),
+            n,
+            "links",
+        )
+        report(
+            f"extract_links, {n} links",
+            timed(lambda: list(cleanurl.extract_links(page, url))),
+            n,
+            "links",
+        )
+
+
+def bench_columns():
+    import tracemalloc
+
+    urls = corpus(100_000)
+    for name, f in (
+        ("list of Result", cleanurl.cleanurl_many),
+        ("list of str", lambda us: [cleanurl.cleanurl_str(u) for u in us]),
+        ("Columns", cleanurl.cleanurl_columns),
+        (
+            "Columns(hosts=True)",
+            lambda us: cleanurl.cleanurl_columns(us, hosts=True),
+        ),
+    ):
+        report(name, timed(f, urls, repeat=1), len(urls))
+        tracemalloc.start()
+        results = f(urls)
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del results
+        print(
+            f"{'':48} {size / len(urls):10.1f} bytes/url"
+            f" {peak / len(urls):8.1f} peak"
+        )
+
+
+def bench_to_bytes():
+    import pickle
+
+    results = cleanurl.cleanurl_many(corpus(100_000))
+    pickled = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+    encoded = cleanurl.encode_results(results)
+    n = len(results)
+    print(f"{'pickle':48} {len(pickled) / n:10.1f} bytes/url")
+    print(f"{'encode_results':48} {len(encoded) / n:10.1f} bytes/url")
+
+    report("pickle.dumps", timed(pickle.dumps, results), n)
+    report("encode_results", timed(cleanurl.encode_results, results), n)
+    report("pickle.loads", timed(pickle.loads, pickled), n)
+    report("decode_results", timed(cleanurl.decode_results, encoded), n)
+
+    # One by one, as in a cache or a queue.
+    results = [r for r in results if r is not None]
+    n = len(results)
+    pickled_each = [pickle.dumps(r, pickle.HIGHEST_PROTOCOL) for r in results]
+    encoded_each = [r.to_bytes() for r in results]
+    print(
+        f"{'pickle one by one':48}"
+        f" {sum(map(len, pickled_each)) / n:10.1f} bytes/url"
+    )
+    print(
+        f"{'Result.to_bytes':48}"
+        f" {sum(map(len, encoded_each)) / n:10.1f} bytes/url"
+    )
+    report(
+        "pickle.dumps one by one",
+        timed(
+            lambda rs: [pickle.dumps(r, pickle.HIGHEST_PROTOCOL) for r in rs],
+            results,
+        ),
+        n,
+    )
+    report(
+        "Result.to_bytes",
+        timed(lambda rs: [r.to_bytes() for r in rs], results),
+        n,
+    )
+    report(
+        "pickle.loads one by one",
+        timed(lambda bs: [pickle.loads(b) for b in bs], pickled_each),
+        n,
+    )
+    report(
+        "Result.from_bytes",
+        timed(
+            lambda bs: [cleanurl.Result.from_bytes(b) for b in bs],
+            encoded_each,
+        ),
+        n,
+    )
+
+
+BENCHMARKS = {
+    name[len("bench_") :]: f
+    for name, f in list(globals().items())
+    if name.startswith("bench_")
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"# {name}")
+        BENCHMARKS[name]()
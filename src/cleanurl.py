@@ -1,9 +1,41 @@
 from __future__ import annotations  # for union type
 from urllib import parse as urlparse
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, Mapping
+import argparse
+import array
+import bisect
+import concurrent.futures
+import contextvars
+import fileinput
+import functools
+import hashlib
+import heapq
+import html.parser
+import http.server
+import ipaddress
+import json
+import multiprocessing
+import os
 import re
+import sqlite3
+import string
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
 import langcodes
 
+# Bump whenever a change to the code of the pipeline or of the site
+# handlers alters the output for some input. Rules.version adds a digest
+# of the data (handler table, host map, tracking parameters and Public
+# Suffix List), so results stored by PersistentCache under older rules
+# are ignored.
+RULES_VERSION = "0.2.0"
+
 
 def __replace_last(s, old, new):
     h, _s, t = s.rpartition(old)
@@ -22,9 +54,97 @@ def __is_lang_tag(s):
     return s and langcodes.tag_is_valid(s)
 
 
+@dataclass
+class TraceStep:
+    """A pipeline stage that changed the url.
+
+    before and after are (host, path, query, fragment). nested holds the
+    steps of cleanurl calls made by the stage on an inner url (AMP and
+    web.archive.org urls).
+    """
+
+    stage: str
+    before: tuple[str, str, str, str]
+    after: tuple[str, str, str, str]
+    nested: list[TraceStep] = field(default_factory=list)
+
+
+class _Tracer:
+    def __init__(self) -> None:
+        self.steps: list[TraceStep] = []
+        self.state = ("", "", "", "")
+        self.nested: list[TraceStep] = []
+
+    def step(self, stage, host, path, parsed_query, fragment):
+        if not isinstance(parsed_query, str):
+            parsed_query = urlparse.urlencode(parsed_query or [])
+        state = (host or "", path or "", parsed_query, fragment or "")
+        if state != self.state or self.nested:
+            self.steps.append(TraceStep(stage, self.state, state, self.nested))
+            self.state = state
+            self.nested = []
+
+
+# Set while a traced cleanurl call runs, so that nested calls made by the
+# handlers are traced too.
+_active_tracer: contextvars.ContextVar[_Tracer | None] = (
+    contextvars.ContextVar("_active_tracer", default=None)
+)
+
+
+@dataclass(frozen=True)
+class Limits:
+    """Bounds on the work done for a single url.
+
+    max_length is in characters, max_query_pairs and max_path_segments
+    are counted before cleaning and max_depth is how many urls wrapped in
+    each other (AMP, web.archive.org, about:reader) are unwrapped. When a
+    limit is exceeded, on_limit decides what happens: "none" makes the
+    call return None, "raise" raises LimitExceeded and "truncate" keeps
+    the first max_* characters, pairs or segments and stops unwrapping.
+    """
+
+    max_length: int = 32768
+    max_query_pairs: int = 1000
+    max_path_segments: int = 1000
+    max_depth: int = 4
+    on_limit: str = "none"
+
+    def __post_init__(self):
+        if self.on_limit not in ("none", "raise", "truncate"):
+            raise ValueError(f"unknown on_limit {self.on_limit!r}")
+
+
+LIMITS = Limits()
+
+
+class LimitExceeded(ValueError):
+    def __init__(self, limit: str, value: int, maximum: int):
+        super().__init__(f"{limit}: {value} > {maximum}")
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+
+
+# (depth, limits, rules) of the outermost cleanurl call, set while it
+# runs so that the urls it unwraps are cleaned the same way.
+_nesting: contextvars.ContextVar[tuple[int, Limits, Rules] | None] = (
+    contextvars.ContextVar("_nesting", default=None)
+)
+
+
+def __exceeded(limits: Limits, limit: str, value: int):
+    """Raise LimitExceeded unless limits.on_limit is "truncate"."""
+    if limits.on_limit != "truncate":
+        raise LimitExceeded(limit, value, getattr(limits, limit))
+
+
 @dataclass
 class Result:
     parsed_url: urlparse.ParseResult
+    trace: list[TraceStep] | None = field(
+        default=None, compare=False, repr=False
+    )
 
     @property
     def scheme(self) -> str | None:
@@ -77,29 +197,428 @@ class Result:
             u = u.removeprefix("//")
         return u
 
+    @property
+    def public_suffix(self) -> str | None:
+        return public_suffix(self.hostname)
+
+    @property
+    def registrable_domain(self) -> str | None:
+        return registrable_domain(self.hostname)
+
+    @property
+    def surt(self) -> str:
+        """Sort-friendly form: com,example)/path?query"""
+        _, netloc, path, params, query, _ = self.parsed_url
+        return _surt(netloc, path, params, query)
+
+    def to_bytes(self) -> bytes:
+        """Compact encoding of the url, without the trace.
+
+        Cheaper to send to other processes or to store than a pickle.
+        """
+        return _encode_result(self.parsed_url)
+
+    @classmethod
+    def from_bytes(cls, data: bytes | bytearray | memoryview) -> Result:
+        """Rebuild a Result encoded by to_bytes without parsing the url."""
+        data = memoryview(data)
+        r, end = _decode_result(data, str(data, "latin-1"), 0)
+        if r is None or end != len(data):
+            raise ValueError("not a single encoded Result")
+        return r
+
+
+# An encoded Result is a tag, the length in bytes of the scheme, netloc,
+# path, params, query and fragment and then the fields in UTF-8. The low
+# bits of the tag tell the size of the lengths: 1, 2 or 4 bytes each,
+# the smallest that fits the longest field. _NON_ASCII is set if any
+# field is not ASCII. A None is just the tag 0.
+_headers = (
+    struct.Struct("<6B"),
+    struct.Struct("<6H"),
+    struct.Struct("<6I"),
+)
+_NON_ASCII = 4
+
+
+def _encode_result(parsed_url) -> bytes:
+    s = "".join(parsed_url)
+    if s.isascii():
+        tag = 0
+        payload = s.encode("ascii")
+        lengths = [len(f) for f in parsed_url]
+    else:
+        tag = _NON_ASCII
+        fields = [f.encode("utf-8", "surrogatepass") for f in parsed_url]
+        payload = b"".join(fields)
+        lengths = [len(f) for f in fields]
+    longest = max(lengths)
+    size = 1 if longest <= 0xFF else 2 if longest <= 0xFFFF else 3
+    return bytes([tag | size]) + _headers[size - 1].pack(*lengths) + payload
+
+
+def _decode_result(buffer: memoryview, text: str, offset: int):
+    """Decode the Result at offset, return it and where the next starts.
+
+    text is buffer decoded as latin-1, ASCII fields are sliced from it.
+    """
+    try:
+        tag = buffer[offset]
+        if tag == 0:
+            return None, offset + 1
+        if not tag & 3 or tag & ~(_NON_ASCII | 3):
+            raise ValueError(f"bad Result at offset {offset}")
+        header = _headers[(tag & 3) - 1]
+        a, b, c, d, e, f = header.unpack_from(buffer, offset + 1)
+    except (IndexError, struct.error):
+        raise ValueError(f"bad Result at offset {offset}") from None
+
+    # Offsets of the fields.
+    a += offset + 1 + header.size
+    b += a
+    c += b
+    d += c
+    e += d
+    f += e
+    if f > len(buffer):
+        raise ValueError(f"truncated Result at offset {offset}")
+
+    start = offset + 1 + header.size
+    if tag & _NON_ASCII:
+        fields = tuple(
+            str(buffer[i:j], "utf-8", "surrogatepass")
+            for i, j in (
+                (start, a),
+                (a, b),
+                (b, c),
+                (c, d),
+                (d, e),
+                (e, f),
+            )
+        )
+    else:
+        fields = (
+            text[start:a],
+            text[a:b],
+            text[b:c],
+            text[c:d],
+            text[d:e],
+            text[e:f],
+        )
+    return Result(tuple.__new__(urlparse.ParseResult, fields)), f
+
+
+def encode_results(results: Iterable[Result | None]) -> bytes:
+    """Encode many results (or None) back to back, see Result.to_bytes."""
+    none = bytes([0])
+    return b"".join(
+        none if r is None else _encode_result(r.parsed_url) for r in results
+    )
+
+
+def decode_results(
+    buffer: bytes | bytearray | memoryview,
+) -> list[Result | None]:
+    """Decode a buffer written by encode_results."""
+    buffer = memoryview(buffer)
+    text = str(buffer, "latin-1")
+    n = len(buffer)
+    results: list[Result | None] = []
+    offset = 0
+    while offset < n:
+        if buffer[offset] != 1 or offset + 7 > n:
+            r, offset = _decode_result(buffer, text, offset)
+            results.append(r)
+            continue
+        # Inlined _decode_result for the common case: an ASCII url with
+        # fields shorter than 256 bytes.
+        a, b, c, d, e, f = _headers[0].unpack_from(buffer, offset + 1)
+        a += offset + 7
+        b += a
+        c += b
+        d += c
+        e += d
+        f += e
+        if f > n:
+            raise ValueError(f"truncated Result at offset {offset}")
+        fields = (
+            text[offset + 7 : a],
+            text[a:b],
+            text[b:c],
+            text[c:d],
+            text[d:e],
+            text[e:f],
+        )
+        results.append(Result(tuple.__new__(urlparse.ParseResult, fields)))
+        offset = f
+    return results
+
+
+def _surt(netloc, path, params, query):
+    host = netloc.rpartition("@")[2]
+    port = ""
+    i = host.rfind(":")
+    if i >= 0 and "]" not in host[i:]:
+        host, port = host[:i], host[i:]
+
+    if host and not host.startswith("[") and not host[-1:].isdigit():
+        labels = host.split(".")
+        labels.reverse()
+        host = ",".join(labels)
+
+    if netloc and not path.startswith("/"):
+        path = "/" + path
+    if params:
+        path += ";" + params
+    if query:
+        path += "?" + query
+
+    if not netloc:
+        return path
+    return host + port + ")" + path
+
+
+def __load_public_suffix_list(path: str) -> dict[str, Any]:
+    trie: dict[str, Any] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            rule = line.split(None, 1)[0] if line.strip() else ""
+            if not rule or rule.startswith("//"):
+                continue
+            mark: bool | str = True
+            if rule.startswith("!"):
+                rule, mark = rule[1:], "!"
+            if not rule.isascii():
+                try:
+                    rule = rule.encode("idna").decode("ascii")
+                except UnicodeError:
+                    continue
+            node = trie
+            for label in reversed(rule.lower().split(".")):
+                node = node.setdefault(label, {})
+            node[""] = mark
+
+    # Most rules end in a leaf, share a single dict for all of them.
+    leaves: dict[Any, dict[str, Any]] = {}
+
+    def compact(node):
+        for label, child in node.items():
+            if not label:
+                continue
+            if len(child) == 1 and "" in child:
+                node[label] = leaves.setdefault(child[""], child)
+            else:
+                compact(child)
+
+    compact(trie)
+    return trie
+
+
+_PUBLIC_SUFFIX_LIST = os.path.join(
+    os.path.dirname(__file__), "cleanurl_public_suffix_list.dat"
+)
+
 
-def __canonical_host(host, respect_semantics):
+@functools.cache
+def _public_suffix_trie() -> dict[str, Any]:
+    """The bundled Public Suffix List as a trie over reversed labels.
+
+    Each node maps a label (or * for wildcard rules) to its child node,
+    the "" key marks the end of a rule: True for normal rules and "!"
+    for exception rules. Loaded on first use.
+    """
+    return __load_public_suffix_list(_PUBLIC_SUFFIX_LIST)
+
+
+def _public_suffix_labels(labels: list[str]) -> int:
+    """Number of trailing labels that form the public suffix."""
+    node = _public_suffix_trie()
+    # The implicit default rule is *.
+    n = 1
+    for i, label in enumerate(reversed(labels), 1):
+        child = node.get(label)
+        if child is None:
+            child = node.get("*")
+            if child is None:
+                break
+        mark = child.get("")
+        if mark == "!":
+            return i - 1
+        if mark:
+            n = i
+        node = child
+    return n
+
+
+def _host_labels(host: str | None) -> list[str] | None:
     if not host:
-        return ""
+        return None
+    host = host.rpartition("@")[2]
+    if host.startswith("["):
+        return None
+    host = host.partition(":")[0].strip(".")
+    if not host or host[-1].isdigit():
+        return None
+    return host.split(".")
+
+
+def public_suffix(host: str | None) -> str | None:
+    """The public suffix of host, e.g. co.uk for www.amazon.co.uk.
+
+    None for IP addresses and empty hosts.
+    """
+    labels = _host_labels(host)
+    if not labels:
+        return None
+    return ".".join(labels[-_public_suffix_labels(labels) :])
+
+
+def registrable_domain(host: str | None) -> str | None:
+    """The public suffix of host plus one label, e.g. amazon.co.uk.
+
+    None if host is itself a public suffix, an IP address or empty.
+    """
+    labels = _host_labels(host)
+    if not labels:
+        return None
+    n = _public_suffix_labels(labels) + 1
+    if n > len(labels):
+        return None
+    return ".".join(labels[-n:])
+
+
+# Site handlers look up the domain of every url they see.
+__registrable_domain = functools.lru_cache(maxsize=65536)(registrable_domain)
+
+
+__default_ports = {
+    "http": "80",
+    "https": "443",
+    "ws": "80",
+    "wss": "443",
+    "ftp": "21",
+}
+
+
+# The stdlib idna codec implements IDNA 2003, which maps these to other
+# characters (ß to ss, ς to σ, joiners to nothing). Browsers follow UTS
+# #46 and keep them, so faß.de and fass.de are different domains.
+__idna_deviations = frozenset("\u00df\u03c2\u200c\u200d")
+
+
+__idna_dots = re.compile("[.\u3002\uff0e\uff61]")
+
+
+def __idna_encode(host):
+    if __idna_deviations.isdisjoint(host):
+        return host.encode("idna").decode("ascii")
+    labels = __idna_dots.split(host)
+    for i, label in enumerate(labels):
+        if __idna_deviations.isdisjoint(label):
+            labels[i] = label.encode("idna").decode("ascii")
+        else:
+            label = unicodedata.normalize("NFKC", label)
+            labels[i] = "xn--" + label.encode("punycode").decode("ascii")
+    return ".".join(labels)
+
+
+def __canonical_hostname(host):
+    if host.startswith("["):
+        try:
+            return "[" + ipaddress.IPv6Address(host[1:-1]).compressed + "]"
+        except ValueError:
+            return host.lower()
 
     host = host.lower()
     host = host.strip(".")
-    host = re.sub(r"\.{2,}", ".", host)
+    if ".." in host:
+        host = re.sub(r"\.{2,}", ".", host)
 
-    if respect_semantics:
-        return host
+    if not host.isascii():
+        try:
+            host = __idna_encode(host)
+        except UnicodeError:
+            pass
+    elif host[-1:].isdigit():
+        try:
+            host = str(ipaddress.IPv4Address(host))
+        except ValueError:
+            pass
 
-    for prefix in ["www.", "ww2.", "m.", "mobile."]:
-        if host.startswith(prefix) and len(host) > (len(prefix) + 1):
-            host = host[len(prefix) :]
+    return host
+
+
+@functools.lru_cache(maxsize=65536)
+def __canonical_host(netloc, scheme, respect_semantics):
+    if not netloc:
+        return ""
+
+    userinfo, _, host = netloc.rpartition("@")
+
+    port = ""
+    i = host.rfind(":")
+    if i >= 0 and "]" not in host[i:]:
+        host, port = host[:i], host[i + 1 :]
+    if port.isdigit():
+        port = str(int(port))
+        if port == __default_ports.get(scheme):
+            port = ""
+
+    host = __canonical_hostname(host)
+
+    if not respect_semantics:
+        userinfo = ""
+        for prefix in ["www.", "ww2.", "m.", "mobile."]:
+            if (
+                host.startswith(prefix)
+                and len(host) > (len(prefix) + 1)
+                and registrable_domain(host[len(prefix) :])
+            ):
+                host = host[len(prefix) :]
+
+    if userinfo:
+        host = userinfo + "@" + host
+    if port:
+        host = host + ":" + port
 
     return host
 
 
+def __percent_table():
+    unreserved = string.ascii_letters + string.digits + "-._~"
+    table = {}
+    for i in range(256):
+        h = f"{i:02X}"
+        value = chr(i) if chr(i) in unreserved else "%" + h
+        for a in {h[0], h[0].lower()}:
+            for b in {h[1], h[1].lower()}:
+                table[a + b] = value
+    return table
+
+
+# Two hex digits -> the unreserved character they encode or the same
+# escape with uppercase hex digits (RFC 3986 section 6.2.2.2).
+__percent = __percent_table()
+
+
+def __canonical_percent_encoding(s):
+    if "%" not in s:
+        return s
+
+    parts = s.split("%")
+    for i in range(1, len(parts)):
+        p = parts[i]
+        r = __percent.get(p[:2])
+        parts[i] = "%" + p if r is None else r + p[2:]
+    return "".join(parts)
+
+
 def __canonical_path(scheme, path, respect_semantics):
     if not path:
         return ""
 
+    path = __canonical_percent_encoding(path)
+
     if scheme in ["", "http", "https", "ftp", "file"]:
         absolute_path, segment = [], None
         for segment in path.split("/"):
@@ -137,27 +656,107 @@ def __canonical_path(scheme, path, respect_semantics):
         ".stm",
         "/",
     ]
+    # Strip by moving end, slicing each time is quadratic.
+    end = len(path)
     found_suffix = True
     while found_suffix:
         found_suffix = False
         for suffix in suffixes:
-            if path.endswith(suffix):
-                path = path[: -len(suffix)]
+            if path.endswith(suffix, 0, end):
+                end -= len(suffix)
                 found_suffix = True
 
-    return path
+    return path[:end]
 
 
-def __canonical_query(query, respect_semantics):
-    pq = urlparse.parse_qs(query, keep_blank_values=True) or {}
+class TrackingParams:
+    """Compiled matcher for query parameters that only carry tracking data.
+
+    patterns are parameter names, a trailing * makes a prefix pattern
+    (utm_* matches utm_source, utm_id, ...). hosts maps a host to
+    patterns that only apply to it and its subdomains. Everything is
+    compiled once in the constructor: names into a frozenset and
+    prefixes into a trie, so a lookup costs one set lookup plus at most
+    one dict lookup per character of the key.
+    """
+
+    def __init__(
+        self,
+        patterns: Iterable[str] = (),
+        hosts: Mapping[str, Iterable[str]] | None = None,
+    ):
+        self.patterns = tuple(dict.fromkeys(patterns))
+        self.hosts = {h: tuple(p) for h, p in (hosts or {}).items()}
+
+        self._names = frozenset(p for p in self.patterns if p[-1:] != "*")
+        self._trie: dict[str, Any] = {}
+        for p in self.patterns:
+            if p[-1:] == "*":
+                node = self._trie
+                for c in p[:-1]:
+                    node = node.setdefault(c, {})
+                node[""] = True
+        self._hosts = {
+            h: TrackingParams(p) for h, p in self.hosts.items() if p
+        }
 
-    queries_to_skip = {
+    def __repr__(self):
+        return f"TrackingParams({self.patterns!r}, hosts={self.hosts!r})"
+
+    @property
+    def digest(self) -> str:
+        """Short fingerprint of the patterns, stable across processes."""
+        h = hashlib.sha1(repr(sorted(self.patterns)).encode())
+        h.update(repr(sorted(self.hosts.items())).encode())
+        return h.hexdigest()[:12]
+
+    def extend(
+        self,
+        patterns: Iterable[str] = (),
+        hosts: Mapping[str, Iterable[str]] | None = None,
+    ) -> TrackingParams:
+        """Return a new matcher with patterns and hosts added to these."""
+        merged = dict(self.hosts)
+        for h, p in (hosts or {}).items():
+            merged[h] = merged.get(h, ()) + tuple(p)
+        return TrackingParams(self.patterns + tuple(patterns), merged)
+
+    @functools.cached_property
+    def non_semantic(self) -> TrackingParams:
+        """These patterns plus the ones removed when semantics don't matter."""
+        return self.extend(_NON_SEMANTIC_PARAMS.patterns)
+
+    def matches(self, key: str) -> bool:
+        """Whether key matches one of the host independent patterns."""
+        if key in self._names:
+            return True
+        node: Any = self._trie
+        for c in key:
+            if "" in node:
+                return True
+            node = node.get(c)
+            if node is None:
+                return False
+        return "" in node
+
+    def for_host(self, host: str) -> list[TrackingParams]:
+        """The per-host matchers that apply to host."""
+        if not self._hosts or not host:
+            return []
+        found = []
+        while True:
+            m = self._hosts.get(host)
+            if m:
+                found.append(m)
+            _, dot, host = host.partition(".")
+            if not dot:
+                return found
+
+
+TRACKING_PARAMS = TrackingParams(
+    [
         # https://en.wikipedia.org/wiki/UTM_parameters
-        "utm_term",
-        "utm_campaign",
-        "utm_content",
-        "utm_source",
-        "utm_medium",
+        "utm_*",
         # https://en.wikipedia.org/wiki/Gclid
         "gclid",
         # https://en.wikipedia.org/wiki/Gclsrc
@@ -166,28 +765,91 @@ def __canonical_query(query, respect_semantics):
         "dclid",
         # https://en.wikipedia.org/wiki/Fbclid
         "fbclid",
-    }
+        "gbraid",
+        "wbraid",
+        "msclkid",
+        "yclid",
+        "twclid",
+        "ttclid",
+        "li_fat_id",
+        "igshid",
+        "igsh",
+        "srsltid",
+        "_ga",
+        "_gl",
+        # Mailchimp
+        "mc_cid",
+        "mc_eid",
+        # HubSpot
+        "_hsenc",
+        "_hsmi",
+        "__hssc",
+        "__hstc",
+        "__hsfp",
+        "hsCtaTracking",
+        # Marketo
+        "mkt_tok",
+        # Vero
+        "vero_*",
+        # Matomo/Piwik
+        "pk_*",
+        "mtm_*",
+        "piwik_*",
+        "matomo_*",
+        # Omeda, Openstat, Wicked Reports, ...
+        "oly_anon_id",
+        "oly_enc_id",
+        "_openstat",
+        "wickedid",
+        "rb_clickid",
+        "s_cid",
+        "ml_subscriber",
+        "ml_subscriber_hash",
+        # Alibaba/Taobao
+        "spm",
+        "scm",
+    ],
+    hosts={
+        "twitter.com": ["src", "ref_src", "ref_url"],
+        "nitter.net": ["src"],
+    },
+)
+
+# Removed only when semantics don't need to be respected.
+_NON_SEMANTIC_PARAMS = TrackingParams(
+    [
+        "cd-origin",
+        "cmpid",
+        "camp",
+        "cid",
+        "ncid",
+        "zanpid",
+        "guccounter",
+        "campaign_id",
+        "tstart",
+    ]
+)
 
-    if not respect_semantics:
-        queries_to_skip |= {
-            "cd-origin",
-            "cmpid",
-            "camp",
-            "cid",
-            "ncid",
-            "zanpid",
-            "guccounter",
-            "campaign_id",
-            "tstart",
-        }
+
+def __canonical_query(query, host, respect_semantics, tracking_params):
+    pq = urlparse.parse_qs(query, keep_blank_values=True) or {}
 
     v = pq.get("hl") or [None]
     if __is_lang_tag(v[0]):
         pq.pop("hl", None)
 
-    return sorted(
-        [(q, v[0]) for q, v in pq.items() if v and q not in queries_to_skip]
-    )
+    if not respect_semantics:
+        tracking_params = tracking_params.non_semantic
+
+    parsed_query = [
+        (q, v[0])
+        for q, v in pq.items()
+        if v and not tracking_params.matches(q)
+    ]
+    for m in tracking_params.for_host(host):
+        parsed_query = [q for q in parsed_query if not m.matches(q[0])]
+
+    return sorted(parsed_query)
 
 
 def __fragment_to_path(scheme, host, path, fragment):
@@ -252,7 +914,9 @@ def __canonical_fragment(scheme, host, path, fragment, respect_semantics):
 
 
 # fixme: the amped url may have a different scheme from the amp url
-def __canonical_amp(host, path, parsed_query, respect_semantics, host_remap):
+def __canonical_amp(
+    host, path, parsed_query, respect_semantics, host_remap, tracking_params
+):
     path_is_amped_url = False
     if host in ("www.google.com", "google.com"):
         if path.startswith("/amp/"):
@@ -265,20 +929,23 @@ def __canonical_amp(host, path, parsed_query, respect_semantics, host_remap):
 
     if path_is_amped_url:
         parts = path.split("/")
-        while parts and "." not in parts[0]:
-            parts = parts[1:]
+        i = 0
+        while i < len(parts) and "." not in parts[i]:
+            i += 1
 
-        path = "//" + "/".join(parts)
+        amped = "//" + "/".join(parts[i:])
         if parsed_query:
-            path += "?" + urlparse.urlencode(parsed_query)
-        amped_url = cleanurl(
-            path,
+            amped += "?" + urlparse.urlencode(parsed_query)
+        amped_url = __nested_cleanurl(
+            amped,
             respect_semantics=respect_semantics,
             host_remap=host_remap,
+            tracking_params=tracking_params,
         )
-        host = amped_url.parsed_url.netloc
-        path = amped_url.parsed_url.path
-        parsed_query = amped_url.parsed_query
+        if amped_url:
+            host = amped_url.parsed_url.netloc
+            path = amped_url.parsed_url.path
+            parsed_query = amped_url.parsed_query
 
     path = path.removeprefix("/amp/")
 
@@ -302,18 +969,22 @@ def __canonical_webarchive(
             url = parts[1]
             url = url.replace("http:/", "http://", 1)
             url = url.replace("https:/", "https://", 1)
-            u = cleanurl(
+            u = __nested_cleanurl(
                 url,
                 generic=False,
                 respect_semantics=respect_semantics,
                 host_remap=host_remap,
             )
+            if u is None:
+                return
             return (
                 u.parsed_url.netloc,
                 u.parsed_url.path,
                 u.parsed_query,
                 u.fragment,
             )
+        except LimitExceeded:
+            raise
         except Exception:
             pass
 
@@ -335,10 +1006,15 @@ def __canonical_youtube(
                 video_id = path_parts[-1]
 
         if video_id:
-            return "youtu.be", "/" + video_id.lower(), [], None
+            if not respect_semantics:
+                video_id = video_id.lower()
+            return "youtu.be", "/" + video_id, [], None
 
     if host_remap and host == "dev.tube" and path.startswith("/video/"):
-        return "youtu.be", path[len("/video") :].lower(), [], None
+        video_path = path[len("/video") :]
+        if not respect_semantics:
+            video_path = video_path.lower()
+        return "youtu.be", video_path, [], None
 
 
 def __canonical_medium(
@@ -488,11 +1164,6 @@ def __canonical_twitter(
             if host_remap:
                 host = "twitter.com"
 
-    queries_to_skip = {"src"}
-    parsed_query = sorted(
-        [q for q in parsed_query if q[0] not in queries_to_skip]
-    )
-
     return host, path, parsed_query, fragment
 
 
@@ -552,16 +1223,27 @@ def __canonical_reddit(
     return host, path, parsed_query, fragment
 
 
+__stackexchange_domains = {
+    "stackoverflow.com",
+    "stackexchange.com",
+    "superuser.com",
+    "serverfault.com",
+    "askubuntu.com",
+    "mathoverflow.net",
+    "stackapps.com",
+}
+
+
 def __canonical_stackoverflow(
     host, path, parsed_query, fragment, respect_semantics, host_remap
 ):
     parts = path.split("/")
     if (
-        host.endswith(".com")
-        and len(parts) == 4
+        len(parts) == 4
         and parts[1] == "questions"
         and __is_integer(parts[2])
         and len(parts[3]) > 0
+        and __registrable_domain(host) in __stackexchange_domains
     ):
         path = "/q/" + parts[2]
         parsed_query = []
@@ -572,13 +1254,13 @@ def __canonical_stackoverflow(
 def __canonical_amazon(
     host, path, parsed_query, fragment, respect_semantics, host_remap
 ):
-    host_parts = host.split(".")
-    if len(host_parts) < 2:
+    if "amazon." not in host:
+        return
+    domain = __registrable_domain(host)
+    if not domain or host not in (domain, "www." + domain):
         return
-    if host_parts[0] == "www":
-        host_parts = host_parts[1:]
 
-    if host_parts[0] == "amazon":
+    if domain.startswith("amazon."):
         parts = path.split("/")
         parts = [p for p in parts if p]
         for i, p in enumerate(parts):
@@ -588,7 +1270,7 @@ def __canonical_amazon(
                 break
 
         if host_remap:
-            host = ".".join(host_parts)
+            host = domain
 
     return host, path, parsed_query, fragment
 
@@ -719,34 +1401,106 @@ def __canonical_typescript(
                 return host, path, [("code", fragment[5:])], None
 
 
+__site_handlers = [
+    __canonical_webarchive,
+    __canonical_youtube,
+    __canonical_medium,
+    __canonical_github,
+    __canonical_bitbucket,
+    __canonical_nytimes,
+    __canonical_techcrunch,
+    __canonical_wikipedia,
+    __canonical_arstechnica,
+    __canonical_bbc,
+    __canonical_twitter,
+    __canonical_mastodon,
+    __canonical_reddit,
+    __canonical_stackoverflow,
+    __canonical_amazon,
+    __canonical_tumblr,
+    __canonical_lwn,
+    __canonical_doi,
+    __canonical_remove_language,
+    __canonical_arxiv,
+    __canonical_djangoproject,
+    __canonical_thenewstack,
+    __canonical_typescript,
+]
+
+
+# Hosts whose urls AMP unwrapping or the site handlers may move to
+# another host. canonical_host relies on these, keep them in sync.
+__amp_hosts = frozenset(["google.com", "www.google.com"])
+__host_changing = frozenset(
+    [
+        "web.archive.org",
+        "youtube.com",
+        "www.youtube.com",
+        "dev.tube",
+        "bbc.co.uk",
+        "threadreaderapp.com",
+        "nitter.net",
+        "www.nitter.net",
+        "www.reddit.com",
+        "old.reddit.com",
+        "www.doi.org",
+        "www.arxiv.org",
+    ]
+)
+__host_changing_suffixes = (".medium.com", ".wikipedia.org", ".bbc.co.uk")
+
+
+def __may_change_host(host, path, fragment, generic, host_remap):
+    if host in __amp_hosts or host.endswith(".cdn.ampproject.org"):
+        return True
+    if generic:
+        return False
+    if (
+        host in __host_changing
+        or host.endswith(__host_changing_suffixes)
+        or "amazon." in host
+    ):
+        return True
+    if not host_remap:
+        return False
+    # __canonical_mastodon and __canonical_doi move any host, depending on
+    # the path (which the fragment may become).
+    s = path + fragment
+    if "%" in s:
+        s = __canonical_percent_encoding(s)
+    return "@" in s or "doi" in s.lower()
+
+
+def __traced_handler(h, tracer):
+    name = h.__name__.lstrip("_")
+
+    def traced(
+        host, path, parsed_query, fragment, respect_semantics, host_remap
+    ):
+        result = h(
+            host, path, parsed_query, fragment, respect_semantics, host_remap
+        )
+        if result:
+            tracer.step(name, *result)
+        return result
+
+    return traced
+
+
 def __canonical_specific_websites(
-    host, path, parsed_query, fragment, respect_semantics, host_remap
+    host,
+    path,
+    parsed_query,
+    fragment,
+    respect_semantics,
+    host_remap,
+    tracer=None,
 ):
-    for h in [
-        __canonical_webarchive,
-        __canonical_youtube,
-        __canonical_medium,
-        __canonical_github,
-        __canonical_bitbucket,
-        __canonical_nytimes,
-        __canonical_techcrunch,
-        __canonical_wikipedia,
-        __canonical_arstechnica,
-        __canonical_bbc,
-        __canonical_twitter,
-        __canonical_mastodon,
-        __canonical_reddit,
-        __canonical_stackoverflow,
-        __canonical_amazon,
-        __canonical_tumblr,
-        __canonical_lwn,
-        __canonical_doi,
-        __canonical_remove_language,
-        __canonical_arxiv,
-        __canonical_djangoproject,
-        __canonical_thenewstack,
-        __canonical_typescript,
-    ]:
+    handlers = __site_handlers
+    if tracer is not None:
+        handlers = [__traced_handler(h, tracer) for h in handlers]
+
+    for h in handlers:
         result = None
         try:
             result = h(
@@ -757,6 +1511,8 @@ def __canonical_specific_websites(
                 respect_semantics,
                 host_remap,
             )
+        except LimitExceeded:
+            raise
         except Exception:
             pass
         if result:
@@ -772,78 +1528,1496 @@ def __canonical_specific_websites(
 __host_map = {"edition.cnn.com": "cnn.com"}
 
 
-def _remap_host(host):
-    return __host_map.get(host, host)
+@dataclass(frozen=True)
+class Rules:
+    """A compiled rule set: host remaps and tracking parameters.
+
+    The site handlers are code and are the same for every rule set.
+    digest identifies the rules file they were loaded from, None for the
+    built-in rules.
+    """
+
+    host_map: Mapping[str, str]
+    tracking_params: TrackingParams
+    digest: str | None = None
+
+    @functools.cached_property
+    def _data_digest(self) -> str:
+        h = hashlib.sha1(_builtin_digest().encode())
+        h.update(repr(sorted(self.host_map.items())).encode())
+        h.update(self.tracking_params.digest.encode())
+        return h.hexdigest()[:12]
+
+    @property
+    def version(self) -> str:
+        """Tags the results in PersistentCache."""
+        version = f"{RULES_VERSION}.{self._data_digest}"
+        if self.digest is None:
+            return version
+        return f"{version}+r{self.digest}"
+
+
+@functools.cache
+def _builtin_digest() -> str:
+    """Digest of the site handler table and of the Public Suffix List."""
+    h = hashlib.sha1(" ".join(f.__name__ for f in __site_handlers).encode())
+    with open(_PUBLIC_SUFFIX_LIST, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+_rules = Rules(__host_map, TRACKING_PARAMS)
+
+
+def active_rules() -> Rules:
+    return _rules
+
+
+def compile_rules(config: Mapping[str, Any], digest: str) -> Rules:
+    """Build the rules described by config on top of the built-in ones.
+
+    config may have "host_map" (host -> host), "tracking_params" (a list
+    of patterns, see TrackingParams) and "site_params" (host -> list of
+    patterns only removed on that host and its subdomains).
+    """
+    host_map = config.get("host_map", {})
+    patterns = config.get("tracking_params", [])
+    site_params = config.get("site_params", {})
+    if not isinstance(host_map, dict) or not all(
+        isinstance(k, str) and isinstance(v, str) for k, v in host_map.items()
+    ):
+        raise ValueError("host_map must map hosts to hosts")
+    if not isinstance(patterns, list) or not all(
+        isinstance(p, str) for p in patterns
+    ):
+        raise ValueError("tracking_params must be a list of patterns")
+    if not isinstance(site_params, dict) or not all(
+        isinstance(p, list) and all(isinstance(q, str) for q in p)
+        for p in site_params.values()
+    ):
+        raise ValueError("site_params must map hosts to lists of patterns")
+
+    return Rules(
+        {**__host_map, **host_map},
+        TRACKING_PARAMS.extend(patterns, site_params),
+        digest,
+    )
+
+
+def load_rules(path) -> Rules:
+    """Compile the JSON rules file at path and make them the active rules.
+
+    Calls already running finish with the rules they started with. The
+    version of the rules includes a digest of the file, so results cached
+    under other rules are ignored.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    rules = compile_rules(
+        json.loads(data), hashlib.sha1(data).hexdigest()[:12]
+    )
+
+    global _rules
+    _rules = rules
+    return rules
 
 
 # todo: add note for schemeless urls
 
 
-def cleanurl(
+def __bounded_path(path: str, limits: Limits) -> str:
+    n = path.count("/")
+    if n > limits.max_path_segments:
+        __exceeded(limits, "max_path_segments", n)
+        path = "/".join(path.split("/", limits.max_path_segments + 1)[:-1])
+    return path
+
+
+def __parse(url: str) -> tuple[str, str, str, str, str, str]:
+    """urlparse(url.strip()) as a plain tuple, without the ParseResult."""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+    params = ""
+    if scheme in urlparse.uses_params and ";" in path:
+        # As urlparse does: params follow the ; of the last segment.
+        i = path.find(";", max(path.rfind("/"), 0))
+        if i >= 0:
+            path, params = path[:i], path[i + 1 :]
+    return scheme, netloc, path, params, query, fragment
+
+
+def __clean(
     url: str | urlparse.ParseResult,
-    generic=False,
-    respect_semantics=False,
-    host_remap=True,
-) -> Result | None:
+    generic,
+    respect_semantics,
+    host_remap,
+    tracking_params: TrackingParams | None,
+    tracer: _Tracer | None = None,
+    limits: Limits | None = None,
+) -> tuple[str, str, str, str, str, str] | None:
+    nesting = _nesting.get()
+    if nesting is not None:
+        # Nested calls use the limits and rules of the outermost one and
+        # let it decide what exceeding the limits means.
+        return __clean_url(
+            url,
+            generic,
+            respect_semantics,
+            host_remap,
+            tracking_params,
+            tracer,
+            nesting[1],
+            nesting[2],
+        )
+
+    if limits is None:
+        limits = LIMITS
+    # _rules is read once per call: load_rules replaces it as a whole.
+    rules = _rules
+    token = _nesting.set((0, limits, rules))
+    try:
+        return __clean_url(
+            url,
+            generic,
+            respect_semantics,
+            host_remap,
+            tracking_params,
+            tracer,
+            limits,
+            rules,
+        )
+    except LimitExceeded:
+        if limits.on_limit == "raise":
+            raise
+        return None
+    finally:
+        _nesting.reset(token)
+
+
+def __clean_url(
+    url: str | urlparse.ParseResult,
+    generic,
+    respect_semantics,
+    host_remap,
+    tracking_params: TrackingParams | None,
+    tracer: _Tracer | None,
+    limits: Limits,
+    rules: Rules,
+) -> tuple[str, str, str, str, str, str] | None:
     if not url:
         return None
 
-    u: urlparse.ParseResult
+    if tracking_params is None:
+        tracking_params = rules.tracking_params
 
+    if not isinstance(url, str) and sum(map(len, url)) > limits.max_length:
+        url = url.geturl()
     if isinstance(url, str):
+        if len(url) > limits.max_length:
+            __exceeded(limits, "max_length", len(url))
+            url = url[: limits.max_length]
         try:
-            u = urlparse.urlparse(url.strip())
+            scheme, netloc, path, params, query, fragment = __parse(url)
         except Exception:
             return None
     else:
-        u = url
+        scheme, netloc, path, params, query, fragment = url
 
-    if u.scheme == "about" and u.path == "reader":
-        pq = urlparse.parse_qs(u.query, keep_blank_values=True)
+    depth = 0
+    while scheme == "about" and path == "reader":
+        pq = urlparse.parse_qs(query, keep_blank_values=True)
         urls = pq.get("url")
-        if urls:
-            return cleanurl(urls[0], generic, respect_semantics, host_remap)
+        if not urls:
+            break
+        if depth == limits.max_depth:
+            __exceeded(limits, "max_depth", depth + 1)
+            break
+        depth += 1
+        if not urls[0]:
+            return None
+        try:
+            scheme, netloc, path, params, query, fragment = __parse(urls[0])
+        except Exception:
+            return None
 
-    scheme = u.scheme
+    if query.count("&") >= limits.max_query_pairs:
+        __exceeded(limits, "max_query_pairs", query.count("&") + 1)
+        query = "&".join(query.split("&", limits.max_query_pairs)[:-1])
 
-    host = __canonical_host(u.netloc, respect_semantics)
-    path = __canonical_path(scheme, u.path, respect_semantics)
-    parsed_query = __canonical_query(u.query, respect_semantics)
-    fragment = u.fragment
+    # Each `if tracer` is a single check per call: the site handlers are
+    # only wrapped when tracing.
+    if tracer:
+        tracer.step("parse", netloc, path, query, fragment)
+
+    host = __canonical_host(netloc, scheme, respect_semantics)
+    if tracer:
+        tracer.step("canonical_host", host, path, query, fragment)
+    path = __canonical_path(
+        scheme, __bounded_path(path, limits), respect_semantics
+    )
+    if tracer:
+        tracer.step("canonical_path", host, path, query, fragment)
+    parsed_query = __canonical_query(
+        query, "" if generic else host, respect_semantics, tracking_params
+    )
+    if tracer:
+        tracer.step("canonical_query", host, path, parsed_query, fragment)
 
     new_path = __fragment_to_path(scheme, host, path, fragment)
     if new_path is not None:
-        path = __canonical_path(scheme, new_path, respect_semantics)
+        path = __canonical_path(
+            scheme, __bounded_path(new_path, limits), respect_semantics
+        )
         fragment = ""
+        if tracer:
+            tracer.step("fragment_to_path", host, path, parsed_query, "")
 
-    fragment = (
+    fragment = __canonical_percent_encoding(
         __canonical_fragment(scheme, host, path, fragment, respect_semantics)
         or ""
     )
+    if tracer:
+        tracer.step("canonical_fragment", host, path, parsed_query, fragment)
 
     result = __canonical_amp(
-        host, path, parsed_query, respect_semantics, host_remap
+        host,
+        path,
+        parsed_query,
+        respect_semantics,
+        host_remap,
+        tracking_params,
     )
     if result:
         host, path, parsed_query = result
         host = host or ""
         path = path or ""
         parsed_query = parsed_query or []
+        if tracer:
+            tracer.step("canonical_amp", host, path, parsed_query, fragment)
 
     if not generic:
         host, path, parsed_query, fragment = __canonical_specific_websites(
-            host, path, parsed_query, fragment, respect_semantics, host_remap
+            host,
+            path,
+            parsed_query,
+            fragment,
+            respect_semantics,
+            host_remap,
+            tracer,
         )
         if host_remap:
-            host = _remap_host(host)
-
-    u = urlparse.ParseResult(
-        scheme=scheme,
-        netloc=host,
-        path=path,
-        params=u.params,
-        query=urlparse.urlencode(parsed_query or []),
-        fragment=fragment,
+            host = rules.host_map.get(host, host)
+            if tracer:
+                tracer.step("remap_host", host, path, parsed_query, fragment)
+
+    return (
+        scheme,
+        host,
+        path,
+        params,
+        urlparse.urlencode(parsed_query) if parsed_query else "",
+        fragment,
+    )
+
+
+def cleanurl(
+    url: str | urlparse.ParseResult,
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+    tracking_params: TrackingParams | None = None,
+    trace=False,
+    limits: Limits | None = None,
+) -> Result | None:
+    if not trace:
+        c = __clean(
+            url,
+            generic,
+            respect_semantics,
+            host_remap,
+            tracking_params,
+            None,
+            limits,
+        )
+        if c is None:
+            return None
+
+        return Result(urlparse.ParseResult(*c))
+
+    tracer = _Tracer()
+    token = _active_tracer.set(tracer)
+    try:
+        c = __clean(
+            url,
+            generic,
+            respect_semantics,
+            host_remap,
+            tracking_params,
+            tracer,
+            limits,
+        )
+    finally:
+        _active_tracer.reset(token)
+    if c is None:
+        return None
+
+    return Result(urlparse.ParseResult(*c), tracer.steps)
+
+
+def __nested_cleanurl(url, **kwargs):
+    """cleanurl for an url wrapped in the one being cleaned.
+
+    Returns None if it is nested deeper than the limits allow and they
+    say to truncate.
+    """
+    depth, limits, rules = _nesting.get() or (0, LIMITS, _rules)
+    if depth == limits.max_depth:
+        __exceeded(limits, "max_depth", depth + 1)
+        return None
+
+    token = _nesting.set((depth + 1, limits, rules))
+    try:
+        parent = _active_tracer.get()
+        if parent is None:
+            return cleanurl(url, **kwargs)
+
+        r = cleanurl(url, trace=True, **kwargs)
+        if r and r.trace:
+            parent.nested.extend(r.trace)
+        return r
+    finally:
+        _nesting.reset(token)
+
+
+def cleanurl_str(
+    url: str | urlparse.ParseResult,
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+    tracking_params: TrackingParams | None = None,
+    limits: Limits | None = None,
+) -> str | None:
+    """Like cleanurl(url).url but without building the Result."""
+    c = __clean(
+        url,
+        generic,
+        respect_semantics,
+        host_remap,
+        tracking_params,
+        None,
+        limits,
+    )
+    if c is None:
+        return None
+
+    return urlparse.urlunparse(c)
+
+
+def canonical_host(
+    url: str | urlparse.ParseResult,
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+    limits: Limits | None = None,
+) -> str | None:
+    """The netloc of cleanurl(url), usually without cleaning the rest.
+
+    The path, query and fragment are only cleaned when a rule that can
+    change the host (AMP, web.archive.org, youtube, mastodon, ...) may
+    apply to the url.
+    """
+    if not url:
+        return None
+    if limits is None:
+        limits = LIMITS
+    if isinstance(url, str):
+        if len(url) > limits.max_length:
+            return __clean_netloc(
+                url, generic, respect_semantics, host_remap, limits
+            )
+        try:
+            u = urlparse.urlparse(url.strip())
+        except Exception:
+            return None
+    else:
+        u = url
+
+    if (
+        u.scheme == "about"
+        or sum(map(len, u)) > limits.max_length
+        or u.query.count("&") >= limits.max_query_pairs
+        or u.path.count("/") > limits.max_path_segments
+    ):
+        return __clean_netloc(
+            u, generic, respect_semantics, host_remap, limits
+        )
+
+    rules = _rules
+    host = __canonical_host(u.netloc, u.scheme, respect_semantics)
+    if __may_change_host(host, u.path, u.fragment, generic, host_remap):
+        return __clean_netloc(
+            u, generic, respect_semantics, host_remap, limits
+        )
+    if not generic and host_remap:
+        host = rules.host_map.get(host, host)
+    return host
+
+
+def partition(
+    url: str | urlparse.ParseResult,
+    shards: int,
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+    limits: Limits | None = None,
+) -> int | None:
+    """The shard in range(shards) that owns url, None if it can't be cleaned.
+
+    It only depends on canonical_host(url), cleaned within limits, so
+    urls that clean to the same url always get the same shard. The shard is the CRC-32 of the
+    host modulo shards, stable across processes and easy to compute in
+    other languages.
+    """
+    if shards < 1:
+        raise ValueError("shards must be at least 1")
+    host = canonical_host(url, generic, respect_semantics, host_remap, limits)
+    if host is None:
+        return None
+    return zlib.crc32(host.encode()) % shards
+
+
+def __clean_netloc(url, generic, respect_semantics, host_remap, limits):
+    c = __clean(
+        url, generic, respect_semantics, host_remap, None, None, limits
     )
+    return None if c is None else c[1]
+
+
+def surt_keys(
+    urls: Iterable[str | urlparse.ParseResult],
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+    tracking_params: TrackingParams | None = None,
+    limits: Limits | None = None,
+) -> Iterator[str | None]:
+    """Yield the cleaned urls of urls in SURT form (see Result.surt)."""
+    for url in urls:
+        c = __clean(
+            url,
+            generic,
+            respect_semantics,
+            host_remap,
+            tracking_params,
+            None,
+            limits,
+        )
+        yield None if c is None else _surt(*c[1:5])
+
+
+def _version(
+    tracking_params: TrackingParams | None, limits: Limits | None = None
+) -> tuple[str, str]:
+    """Version of the active rules, digest of custom tracking_params and
+    limits."""
+    rules = _rules
+    params = ""
+    if (
+        tracking_params is not None
+        and tracking_params is not rules.tracking_params
+    ):
+        params = tracking_params.digest
+    if limits is not None and limits != LIMITS:
+        params += "+l" + hashlib.sha1(repr(limits).encode()).hexdigest()[:12]
+    return rules.version, params
+
+
+def _flags(generic, respect_semantics, host_remap) -> int:
+    return (
+        int(bool(generic))
+        | int(bool(respect_semantics)) << 1
+        | int(bool(host_remap)) << 2
+    )
+
+
+class PersistentCache:
+    """On-disk cache of url -> Result backed by sqlite3.
+
+    Entries are keyed by the input url and the cleanurl flags and are
+    tagged with the version of the active rules and the digest of custom
+    tracking_params and limits, if any: entries written by other rules
+    are ignored and are the first to go on compaction. When the cache grows
+    past max_entries the oldest entries are removed until it is down to
+    compact_to * max_entries.
+    """
+
+    batch_size = 500
+    # Bumped when the table changes, older caches are dropped.
+    schema = 3
+
+    def __init__(self, path, max_entries=1_000_000, compact_to=0.8):
+        self.path = path
+        self.max_entries = max_entries
+        self.compact_to = compact_to
+        self._db = sqlite3.connect(path)
+        (schema,) = self._db.execute("PRAGMA user_version").fetchone()
+        if schema != self.schema:
+            self._db.execute("DROP TABLE IF EXISTS cleanurl")
+        # Results are stored with Result.to_bytes: a url string would
+        # not always parse back to the same components.
+        self._db.executescript(f"""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA user_version = {self.schema};
+            CREATE TABLE IF NOT EXISTS cleanurl (
+                url TEXT NOT NULL,
+                flags INTEGER NOT NULL,
+                version TEXT NOT NULL,
+                params TEXT NOT NULL,
+                result BLOB,
+                PRIMARY KEY (url, flags, params)
+            );
+            """)
+        self._size = len(self)
+
+    def __len__(self):
+        return self._db.execute("SELECT count(*) FROM cleanurl").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_many(
+        self,
+        urls: Iterable[str],
+        generic=False,
+        respect_semantics=False,
+        host_remap=True,
+        tracking_params: TrackingParams | None = None,
+        limits: Limits | None = None,
+    ) -> dict[str, Result | None]:
+        """Return the cached results for urls, missing urls are left out."""
+        flags = _flags(generic, respect_semantics, host_remap)
+        version, params = _version(tracking_params, limits)
+        urls = list(dict.fromkeys(urls))
+        found: dict[str, Result | None] = {}
+        for i in range(0, len(urls), self.batch_size):
+            batch = urls[i : i + self.batch_size]
+            for url, result in self._db.execute(
+                "SELECT url, result FROM cleanurl"
+                " WHERE flags = ? AND version = ? AND params = ?"
+                f" AND url IN ({','.join('?' * len(batch))})",
+                (flags, version, params, *batch),
+            ):
+                found[url] = (
+                    None if result is None else Result.from_bytes(result)
+                )
+        return found
+
+    def put_many(
+        self,
+        items: Iterable[tuple[str, Result | None]],
+        generic=False,
+        respect_semantics=False,
+        host_remap=True,
+        tracking_params: TrackingParams | None = None,
+        limits: Limits | None = None,
+    ):
+        """Store (url, Result) pairs in a single transaction."""
+        flags = _flags(generic, respect_semantics, host_remap)
+        version, params = _version(tracking_params, limits)
+        rows = [
+            (u, flags, version, params, None if r is None else r.to_bytes())
+            for u, r in items
+        ]
+        if not rows:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO cleanurl VALUES (?, ?, ?, ?, ?)", rows
+            )
+        self._size += len(rows)
+        if self._size > self.max_entries:
+            self.compact()
+
+    def compact(self):
+        """Drop stale entries, then the oldest ones if still over the cap."""
+        with self._db:
+            self._db.execute(
+                "DELETE FROM cleanurl WHERE version != ?", (_rules.version,)
+            )
+            size = len(self)
+            target = int(self.max_entries * self.compact_to)
+            if size > self.max_entries:
+                self._db.execute(
+                    "DELETE FROM cleanurl WHERE rowid IN"
+                    " (SELECT rowid FROM cleanurl ORDER BY rowid LIMIT ?)",
+                    (size - target,),
+                )
+                size = target
+        self._size = size
+
+
+def __result(parsed_url, intern):
+    if intern:
+        scheme, netloc, *rest = parsed_url
+        parsed_url = (sys.intern(scheme), sys.intern(netloc), *rest)
+    return Result(urlparse.ParseResult(*parsed_url))
+
+
+def cleanurl_many(
+    urls: Iterable[str],
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+    tracking_params: TrackingParams | None = None,
+    cache: PersistentCache | None = None,
+    intern=False,
+    limits: Limits | None = None,
+) -> list[Result | None]:
+    """Clean many urls at once.
+
+    If cache is given, urls are first looked up in bulk and only the
+    missing ones are cleaned and then stored back in one transaction.
+
+    With intern=True schemes and hosts of the results are interned, so
+    results sharing a host share the same string.
+    """
+    if cache is None:
+        return [
+            None if c is None else __result(c, intern)
+            for c in (
+                __clean(
+                    u,
+                    generic,
+                    respect_semantics,
+                    host_remap,
+                    tracking_params,
+                    None,
+                    limits,
+                )
+                for u in urls
+            )
+        ]
+
+    urls = list(urls)
+    rules = _rules
+    cached = cache.get_many(
+        urls, generic, respect_semantics, host_remap, tracking_params, limits
+    )
+    missing: dict[str, Result | None] = {}
+    results: list[Result | None] = []
+    for url in urls:
+        if url in cached:
+            c = cached[url]
+            if c is not None and intern:
+                c = __result(c.parsed_url, intern)
+            results.append(c)
+        else:
+            r = __clean(
+                url,
+                generic,
+                respect_semantics,
+                host_remap,
+                tracking_params,
+                None,
+                limits,
+            )
+            result = None if r is None else __result(r, intern)
+            results.append(result)
+            cached[url] = missing[url] = result
+
+    # If load_rules ran meanwhile some results may be cleaned with the
+    # old rules and some with the new ones, don't store them.
+    if _rules is rules:
+        cache.put_many(
+            missing.items(),
+            generic,
+            respect_semantics,
+            host_remap,
+            tracking_params,
+            limits,
+        )
+
+    return results
+
+
+@dataclass
+class Columns:
+    """Cleaned urls laid out like an Arrow large_string column.
+
+    Url i is data[offsets[i]:offsets[i + 1]] in UTF-8, and is None when
+    bit i of validity (least significant bit first) is not set. With
+    hosts, host_indices[i] is the index of its host in the dictionary
+    column host_data/host_offsets. These are plain buffers, so tools
+    like pyarrow (pa.LargeStringArray.from_buffers) and numpy
+    (np.frombuffer) can use them without copying.
+    """
+
+    data: bytearray = field(default_factory=bytearray)
+    offsets: array.array = field(default_factory=lambda: array.array("q", [0]))
+    validity: bytearray = field(default_factory=bytearray)
+    host_indices: array.array | None = None
+    host_data: bytearray | None = None
+    host_offsets: array.array | None = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str | None:
+        if not self.validity[i >> 3] & 1 << (i & 7):
+            return None
+        return self.data[self.offsets[i] : self.offsets[i + 1]].decode()
+
+    def host(self, i: int) -> str | None:
+        if self.host_indices is None:
+            raise ValueError("hosts were not collected")
+        if not self.validity[i >> 3] & 1 << (i & 7):
+            return None
+        assert self.host_data is not None and self.host_offsets is not None
+        h = self.host_indices[i]
+        start, end = self.host_offsets[h], self.host_offsets[h + 1]
+        return self.host_data[start:end].decode()
+
+    def __iter__(self) -> Iterator[str | None]:
+        return (self[i] for i in range(len(self)))
+
+
+def cleanurl_columns(
+    urls: Iterable[str],
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+    tracking_params: TrackingParams | None = None,
+    hosts=False,
+    limits: Limits | None = None,
+) -> Columns:
+    """Clean urls straight into Columns, without a Python object per url.
+
+    With hosts=True the hosts of the cleaned urls are stored too,
+    dictionary encoded. Urls that aren't valid UTF-8 (lone surrogates)
+    are null, like urls that can't be cleaned.
+    """
+    columns = Columns()
+    data, offsets, validity = columns.data, columns.offsets, columns.validity
+    if hosts:
+        host_index: dict[str, int] = {}
+        host_indices = columns.host_indices = array.array("i")
+        host_data = columns.host_data = bytearray()
+        host_offsets = columns.host_offsets = array.array("q", [0])
+
+    for i, url in enumerate(urls):
+        if not i & 7:
+            validity.append(0)
+        c = __clean(
+            url,
+            generic,
+            respect_semantics,
+            host_remap,
+            tracking_params,
+            None,
+            limits,
+        )
+        try:
+            encoded = None if c is None else urlparse.urlunparse(c).encode()
+        except UnicodeEncodeError:
+            # Lone surrogates, Arrow strings must be valid UTF-8.
+            encoded = None
+        if c is None or encoded is None:
+            offsets.append(len(data))
+            if hosts:
+                host_indices.append(0)
+            continue
+
+        data += encoded
+        offsets.append(len(data))
+        validity[i >> 3] |= 1 << (i & 7)
+        if hosts:
+            h = host_index.get(c[1])
+            if h is None:
+                h = host_index[c[1]] = len(host_index)
+                host_data += c[1].encode()
+                host_offsets.append(len(host_data))
+            host_indices.append(h)
+
+    return columns
+
+
+# The first urls are escaped in run files: they come from add_many and
+# may contain \n. Cleaned urls never do, urlsplit removes it.
+_first_escape = re.compile(r"\\(.)", re.DOTALL)
+
+
+def _escape_first(first: str | None) -> str:
+    if not first:
+        return ""
+    return first.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _unescape_first(first: str) -> str:
+    if "\\" not in first:
+        return first
+    return _first_escape.sub(lambda m: "\n" if m[1] == "n" else m[1], first)
+
+
+class Deduplicator:
+    """Count distinct cleaned urls with bounded memory.
+
+    Cleaned urls are counted in a dict until its estimated size reaches
+    memory_limit bytes, then the dict is sorted and spilled to a run file
+    in tmpdir. Iterating merges the runs and yields (cleaned url, count,
+    first url seen) in cleaned url order. first is None unless
+    keep_first is set.
+    """
+
+    # Rough per entry overhead of the dict and its values.
+    entry_overhead = 100
+    max_open_runs = 256
+
+    def __init__(
+        self,
+        memory_limit=256 * 2**20,
+        keep_first=False,
+        tmpdir=None,
+        generic=False,
+        respect_semantics=False,
+        host_remap=True,
+    ) -> None:
+        self.memory_limit = memory_limit
+        self.keep_first = keep_first
+        self.options = (generic, respect_semantics, host_remap)
+        self.stats = {
+            "urls": 0,
+            "runs": 0,
+            "distinct": 0,
+            "clean_seconds": 0.0,
+            "merge_seconds": 0.0,
+        }
+        self._tmpdir = tempfile.TemporaryDirectory(dir=tmpdir)
+        self._runs: list[str] = []
+        self._counts: dict[str, list] = {}
+        self._memory = 0
+
+    def add_many(self, urls: Iterable[str]):
+        start = time.perf_counter()
+        generic, respect_semantics, host_remap = self.options
+        counts = self._counts
+        n = 0
+        for url in urls:
+            key = cleanurl_str(url, generic, respect_semantics, host_remap)
+            if not key:
+                continue
+            n += 1
+            c = counts.get(key)
+            if c is not None:
+                c[0] += 1
+                continue
+            counts[key] = [1, url.strip() if self.keep_first else None]
+            self._memory += sys.getsizeof(key) + self.entry_overhead
+            if self.keep_first:
+                self._memory += sys.getsizeof(url)
+            if self._memory >= self.memory_limit:
+                self._spill()
+                counts = self._counts
+        self.stats["urls"] += n
+        self.stats["clean_seconds"] += time.perf_counter() - start
+
+    def add(self, url: str):
+        self.add_many((url,))
+
+    def _new_run(self):
+        path = os.path.join(self._tmpdir.name, f"run{self.stats['runs']}")
+        self.stats["runs"] += 1
+        return path, open(
+            path,
+            "w",
+            encoding="utf-8",
+            errors="surrogateescape",
+            newline="\n",
+        )
+
+    def _spill(self):
+        path, f = self._new_run()
+        self._runs.append(path)
+        with f:
+            for key in sorted(self._counts):
+                count, first = self._counts[key]
+                f.write(f"{key}\t{count}\t{_escape_first(first)}\n")
+        self._counts = {}
+        self._memory = 0
+
+    @staticmethod
+    def _read_run(path, index):
+        # Only \n ends a line: the original urls may contain a lone \r.
+        with open(
+            path, encoding="utf-8", errors="surrogateescape", newline="\n"
+        ) as f:
+            for line in f:
+                key, count, first = line.rstrip("\n").split("\t", 2)
+                yield key, index, int(count), first
+
+    def _merge(self, runs):
+        # Runs are written in input order, so for equal keys the run with
+        # the lowest index saw the url first.
+        key, count, first = None, 0, None
+        for k, _, c, f in heapq.merge(
+            *(self._read_run(p, i) for i, p in enumerate(runs))
+        ):
+            if k == key:
+                count += c
+            else:
+                if key is not None:
+                    yield key, count, first
+                key, count, first = k, c, f
+        if key is not None:
+            yield key, count, first
+
+    def __iter__(self):
+        start = time.perf_counter()
+        if self._counts or not self._runs:
+            self._spill()
+
+        # Merge in several passes if there are too many runs to open at
+        # once.
+        while len(self._runs) > self.max_open_runs:
+            runs = self._runs[: self.max_open_runs]
+            path, f = self._new_run()
+            self._runs[: self.max_open_runs] = [path]
+            with f:
+                for key, count, first in self._merge(runs):
+                    f.write(f"{key}\t{count}\t{first}\n")
+            for p in runs:
+                os.remove(p)
+
+        for key, count, first in self._merge(self._runs):
+            self.stats["distinct"] += 1
+            yield key, count, (
+                _unescape_first(first) if self.keep_first else None
+            )
+        self.stats["merge_seconds"] += time.perf_counter() - start
+
+    def close(self):
+        self._tmpdir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _LinkExtractor(html.parser.HTMLParser):
+    """Collects the distinct hrefs of a document, cleaned, in pending.
+
+    The base url is split once into the prefixes relative links are
+    appended to, instead of parsing it again for each urljoin. Dot
+    segments are left to cleanurl, which removes them anyway.
+    """
+
+    _scheme = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*:")
+
+    def __init__(self, url: str, clean_options: tuple) -> None:
+        super().__init__(convert_charrefs=True)
+        self.url = url
+        self.clean_options = clean_options
+        self.pending: list[tuple[str, Result | None]] = []
+        self._seen: set[str] = set()
+        self._has_base = False
+        self._set_base(url)
+
+    def _set_base(self, url: str):
+        u = urlparse.urlsplit(url)
+        origin = f"{u.scheme}://{u.netloc}" if u.netloc else f"{u.scheme}:"
+        path = u.path or "/"
+        self._base_scheme = u.scheme
+        self._origin = origin
+        self._dir = origin + path[: path.rfind("/") + 1]
+        self._path = origin + path
+        self._query = self._path + (f"?{u.query}" if u.query else "")
+
+    def resolve(self, href: str) -> str:
+        if href.startswith("//"):
+            return f"{self._base_scheme}:{href}"
+        if href.startswith("/"):
+            return self._origin + href
+        if href.startswith("#"):
+            return self._query + href
+        if href.startswith("?"):
+            return self._path + href
+        if self._scheme.match(href):
+            return href
+        return self._dir + href
+
+    def handle_starttag(self, tag, attrs):
+        for name, href in attrs:
+            if name == "href" and href:
+                break
+        else:
+            return
+
+        if tag == "base":
+            # Only the first <base href> counts.
+            if not self._has_base:
+                self._has_base = True
+                self._set_base(urlparse.urljoin(self.url, href.strip()))
+            return
+
+        href = href.strip()
+        if not href or href in self._seen:
+            return
+        self._seen.add(href)
+        self.pending.append(
+            (href, cleanurl(self.resolve(href), *self.clean_options))
+        )
+
+
+def extract_links(
+    document: str | Iterable[str],
+    url: str,
+    generic=False,
+    respect_semantics=False,
+    host_remap=True,
+) -> Iterator[tuple[str, Result | None]]:
+    """Yield (href, cleaned link) for the distinct links of an HTML page.
+
+    document is the HTML of the page at url, as a string or as chunks
+    that are parsed as they come. Links are resolved against url, or the
+    <base href> of the page, and each distinct href is cleaned once.
+    """
+    parser = _LinkExtractor(url, (generic, respect_semantics, host_remap))
+    for chunk in [document] if isinstance(document, str) else document:
+        parser.feed(chunk)
+        yield from parser.pending
+        parser.pending.clear()
+    parser.close()
+    yield from parser.pending
+
+
+def _clean_batch(urls, generic, respect_semantics, host_remap, rules=None):
+    # Worker processes get the rules of the server with each batch and
+    # never read the rules file, which may have changed since.
+    global _rules
+    if rules is not None and rules.version != _rules.version:
+        _rules = rules
+    return [
+        cleanurl_str(u, generic, respect_semantics, host_remap) for u in urls
+    ]
+
+
+class _Metrics:
+    """Throughput and latency counters, in the Prometheus text format."""
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.urls = 0
+        self.seconds = 0.0
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.rules_reloads = 0
+        self.rules_errors = 0
+
+    def observe(self, seconds: float, urls: int, error=False):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.urls += urls
+            self.seconds += seconds
+            self.counts[i] += 1
+
+    def render(self) -> str:
+        with self._lock:
+            counts = list(self.counts)
+            lines = [
+                f"cleanurl_requests_total {self.requests}",
+                f"cleanurl_errors_total {self.errors}",
+                f"cleanurl_urls_total {self.urls}",
+                f"cleanurl_uptime_seconds {time.time() - self.started:.3f}",
+                f"cleanurl_request_seconds_sum {self.seconds:.6f}",
+                f"cleanurl_request_seconds_count {self.requests}",
+                f"cleanurl_rules_reloads_total {self.rules_reloads}",
+                f"cleanurl_rules_errors_total {self.rules_errors}",
+                f'cleanurl_rules_info{{version="{_rules.version}"}} 1',
+            ]
+        total = 0
+        for le, count in zip((*self.buckets, "+Inf"), counts):
+            total += count
+            lines.append(
+                f'cleanurl_request_seconds_bucket{{le="{le}"}} {total}'
+            )
+        return "\n".join(lines) + "\n"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: Server
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int, message: str, start: float):
+        self._send(status, "text/plain; charset=utf-8", message.encode())
+        self.server.metrics.observe(time.perf_counter() - start, 0, True)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send(
+                200,
+                "text/plain; version=0.0.4",
+                self.server.metrics.render().encode(),
+            )
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def do_POST(self):
+        start = time.perf_counter()
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.close_connection = True
+            self._error(411, "Content-Length required", start)
+            return
+        if length < 0:
+            self.close_connection = True
+            self._error(400, "negative Content-Length", start)
+            return
+        if length > self.server.max_body:
+            # The body is left unread, so the connection can't be reused.
+            self.close_connection = True
+            self._error(413, f"body larger than {self.server.max_body}", start)
+            return
+        body = self.rfile.read(length)
+        u = urlparse.urlsplit(self.path)
+        if u.path != "/clean":
+            self._error(404, "not found", start)
+            return
+
+        query = urlparse.parse_qs(u.query)
+        flags = {
+            name: query.get(name, [str(default)])[-1].lower()
+            in ("1", "true", "yes")
+            for name, default in (
+                ("generic", False),
+                ("respect_semantics", False),
+                ("host_remap", True),
+            )
+        }
+        is_json = self.headers.get_content_type() == "application/json"
+        try:
+            if is_json:
+                batch = json.loads(body)
+                if isinstance(batch, dict):
+                    for name in flags:
+                        value = batch.get(name, flags[name])
+                        if not isinstance(value, bool):
+                            raise ValueError(f"{name} must be true or false")
+                        flags[name] = value
+                    batch = batch.get("urls")
+                if not isinstance(batch, list) or not all(
+                    isinstance(url, str) for url in batch
+                ):
+                    raise ValueError("expected a list of urls")
+                urls = batch
+            else:
+                # Only \n ends a line, str.splitlines would also split on
+                # \x0b, \x85, U+2028 and others.
+                urls = body.decode().split("\n")
+                if urls[-1] == "":
+                    urls.pop()
+                urls = [u.removesuffix("\r") for u in urls]
+        except (ValueError, RecursionError) as e:
+            self._error(400, str(e), start)
+            return
+
+        try:
+            results = self.server.clean(urls, **flags)
+        except Exception as e:
+            self._error(500, f"{type(e).__name__}: {e}", start)
+            return
+        if is_json:
+            self._send(
+                200,
+                "application/json",
+                json.dumps({"urls": results}).encode(),
+            )
+        else:
+            self._send(
+                200,
+                "text/plain; charset=utf-8",
+                "".join(f"{r or ''}\n" for r in results).encode(),
+            )
+        self.server.metrics.observe(time.perf_counter() - start, len(urls))
+
+
+class Server(http.server.ThreadingHTTPServer):
+    """HTTP service cleaning batches of urls, used by `cleanurl serve`.
+
+    POST /clean takes either a JSON list of urls (or an object with a
+    "urls" list and the generic, respect_semantics and host_remap flags
+    as JSON booleans) and answers {"urls": [cleaned url or null, ...]},
+    or plain text with one url per line and answers one cleaned url per
+    line, empty if the url couldn't be cleaned. For plain text the flags
+    go in the query string. GET /metrics returns the request, url and
+    latency counters and the version of the active rules.
+
+    With rules_path the rules are loaded from that file (see load_rules)
+    and reloaded whenever it changes, checking every rules_interval
+    seconds. A file that fails to load leaves the previous rules active.
+
+    Connections are kept alive and each one is served by its own thread.
+    Batches larger than min_chunk urls are split among a pool of workers
+    processes, if workers > 0, since threads alone can't clean in
+    parallel.
+    """
+
+    daemon_threads = True
+    min_chunk = 1000
+
+    def __init__(
+        self,
+        address: tuple[str, int] = ("127.0.0.1", 8080),
+        workers=0,
+        max_body=16 * 2**20,
+        rules_path=None,
+        rules_interval=5.0,
+    ) -> None:
+        self.max_body = max_body
+        self.workers = workers
+        self.metrics = _Metrics()
+        self.rules_path = rules_path
+        self._closed = threading.Event()
+        if rules_path is not None:
+            self._rules_mtime = os.stat(rules_path).st_mtime_ns
+            load_rules(rules_path)
+            threading.Thread(
+                target=self._watch_rules, args=(rules_interval,), daemon=True
+            ).start()
+        self.pool = (
+            # The pool is started from a handler thread, where forking
+            # isn't safe.
+            concurrent.futures.ProcessPoolExecutor(
+                workers, multiprocessing.get_context("spawn")
+            )
+            if workers > 0
+            else None
+        )
+        super().__init__(address, _Handler)
+
+    def _watch_rules(self, interval: float):
+        while not self._closed.wait(interval):
+            try:
+                mtime = os.stat(self.rules_path).st_mtime_ns
+                if mtime == self._rules_mtime:
+                    continue
+                self._rules_mtime = mtime
+                load_rules(self.rules_path)
+                self.metrics.rules_reloads += 1
+            except (OSError, ValueError) as e:
+                self.metrics.rules_errors += 1
+                print(f"{self.rules_path}: {e}", file=sys.stderr)
+
+    def clean(
+        self, urls: list[str], generic, respect_semantics, host_remap
+    ) -> list[str | None]:
+        flags = (generic, respect_semantics, host_remap)
+        if self.pool is None or len(urls) <= self.min_chunk:
+            return _clean_batch(urls, *flags)
+        n = max(self.min_chunk, -(-len(urls) // self.workers))
+        rules = _rules
+        futures = [
+            self.pool.submit(_clean_batch, urls[i : i + n], *flags, rules)
+            for i in range(0, len(urls), n)
+        ]
+        return [r for f in futures for r in f.result()]
+
+    def server_close(self):
+        super().server_close()
+        self._closed.set()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def __report(name, seconds, n, what):
+    print(
+        f"{name}: {n} {what} in {seconds:.2f}s"
+        f" ({n / seconds if seconds else 0:,.0f} {what}/s)",
+        file=sys.stderr,
+    )
+
+
+def __input(files):
+    """Lines of files or stdin. Bytes that aren't UTF-8 are kept as
+    surrogates and written back as they were to stdout."""
+    for stream in (sys.stdin, sys.stdout):
+        reconfigure = getattr(stream, "reconfigure", None)
+        if reconfigure is not None:
+            reconfigure(errors="surrogateescape")
+    return fileinput.input(
+        files, openhook=fileinput.hook_encoded("utf-8", "surrogateescape")
+    )
+
+
+def __command_clean(args, options):
+    for line in __input(args.files):
+        print(cleanurl_str(line, *options) or "")
+
+
+def __command_dedup(args, options):
+    with Deduplicator(
+        memory_limit=args.memory * 2**20,
+        keep_first=args.first,
+        tmpdir=args.tmpdir,
+        generic=options[0],
+        respect_semantics=options[1],
+        host_remap=options[2],
+    ) as d:
+        d.add_many(__input(args.files))
+        s = d.stats
+        __report("clean", s["clean_seconds"], s["urls"], "urls")
+        for key, count, first in d:
+            if args.first:
+                print(f"{count}\t{key}\t{first}")
+            else:
+                print(f"{count}\t{key}")
+        __report("merge", s["merge_seconds"], s["distinct"], "distinct")
+        print(f"runs: {s['runs']}", file=sys.stderr)
+
+
+def __command_serve(args):
+    with Server(
+        (args.host, args.port),
+        args.workers,
+        args.max_body,
+        args.rules,
+        args.rules_interval,
+    ) as s:
+        host, port = s.server_address[:2]
+        print(
+            f"listening on http://{host}:{port}", file=sys.stderr, flush=True
+        )
+        try:
+            s.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv=None):
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument(
+        "--generic", action="store_true", help="don't use site specific rules"
+    )
+    options.add_argument(
+        "--respect-semantics",
+        action="store_true",
+        help="make sure the cleaned urls are still valid",
+    )
+    options.add_argument(
+        "--no-host-remap",
+        dest="host_remap",
+        action="store_false",
+        help="don't remap hosts",
+    )
+    options.add_argument(
+        "--rules", help="JSON file with extra host remaps and tracking params"
+    )
+    options.add_argument(
+        "files", nargs="*", help="files with one url per line (default stdin)"
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="cleanurl",
+        description="Remove clutter from URLs and return a canonicalized"
+        " version",
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser(
+        "clean", parents=[options], help="clean urls, one per line"
+    )
+    dedup = commands.add_parser(
+        "dedup",
+        parents=[options],
+        help="print distinct cleaned urls with their count, sorted",
+    )
+    dedup.add_argument(
+        "--memory",
+        type=int,
+        default=256,
+        help="memory budget in MiB before spilling to disk (default 256)",
+    )
+    dedup.add_argument(
+        "--first",
+        action="store_true",
+        help="also print the first url seen for each cleaned url",
+    )
+    dedup.add_argument("--tmpdir", help="directory for the spilled runs")
+    serve = commands.add_parser(
+        "serve", help="clean batches of urls sent over http"
+    )
+    serve.add_argument("--host", default="127.0.0.1", help="default 127.0.0.1")
+    serve.add_argument(
+        "--port", type=int, default=8080, help="default 8080, 0 for any"
+    )
+    serve.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="processes cleaning large batches (default 0, in the server)",
+    )
+    serve.add_argument(
+        "--max-body",
+        type=int,
+        default=16 * 2**20,
+        help="largest accepted request body in bytes (default 16 MiB)",
+    )
+    serve.add_argument(
+        "--rules",
+        help="JSON file with extra host remaps and tracking params,"
+        " reloaded when it changes",
+    )
+    serve.add_argument(
+        "--rules-interval",
+        type=float,
+        default=5.0,
+        help="seconds between checks of the rules file (default 5)",
+    )
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ("clean", "dedup", "serve", "-h", "--help"):
+        argv = ["clean", *argv]
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        __command_serve(args)
+        return
+    if args.rules:
+        try:
+            load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            parser.error(f"--rules: {e}")
+    flags = (args.generic, args.respect_semantics, args.host_remap)
+
+    if args.command == "dedup":
+        __command_dedup(args, flags)
+    else:
+        __command_clean(args, flags)
+
 
-    return Result(u)
+if __name__ == "__main__":
+    main()